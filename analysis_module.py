@@ -1,22 +1,45 @@
-import datetime
+import hashlib
+import io
 from typing import List, Dict, Tuple
 import sqlite3
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
 import numpy as np
+import pandas as pd
+from numba import njit
 import streamlit as st
 
-# Helper Classes
-class Consumer:
-    def __init__(self, type_id: int, type: str, time: datetime.datetime, val: float):
-        self.type_id = type_id 
-        self.type = type 
-        self.val = val
-        self.time = time
-
-    def __repr__(self):
-        return f"<Consumer type={self.type}, value={self.val}, start={self.time}>"
+# Optional columnar reader, the queries fall back to sqlite3 + pandas without it
+try:
+    import adbc_driver_sqlite.dbapi as adbc_sqlite
+except ImportError:
+    adbc_sqlite = None
+
+# Hourly time axis covered by the dataset (first and last hour, in epoch seconds)
+START_EPOCH = 886712400
+END_EPOCH = 918244800
+NR_HOURS = (END_EPOCH - START_EPOCH) // 3600 + 1
+HOUR_AXIS = np.datetime64(START_EPOCH, 's') + np.arange(NR_HOURS) * np.timedelta64(1, 'h')
+
+# Connection settings for the reads: no fsync, in-memory journal and temp store, a 256 MB mmap and a 200 MB page cache
+READ_PRAGMAS = ('PRAGMA synchronous=OFF', 'PRAGMA journal_mode=MEMORY', 'PRAGMA temp_store=MEMORY',
+                'PRAGMA mmap_size=268435456', 'PRAGMA cache_size=-200000')
+
+# Appliances of the house whose consumption is analysed
+APPLIANCES = {
+    0: 'water pump',
+    1: 'water heater',
+    2: 'washing machine',
+    4: 'freezer',
+    5: 'fridge freezer',
+    6: 'total site light',
+    7: 'TV',
+    9: 'boiler'
+}
 
+# Helper Classes
 class House:
     def __init__(self, id_house: int, city: str):
         self.id_house = id_house
@@ -25,58 +48,181 @@ class House:
     def __repr__(self):
         return f"<House id={self.id_house}, address={self.city}>"
 
-class Production:
-    def __init__(self, val: float, time: datetime.datetime):
-        self.val = val
-        self.time = time
-
-    def __repr__(self):
-        return f"<value={self.val}W, hour={self.time}>"
-
-class Rayonnement:
-    def __init__(self, val: float, time: datetime.datetime):
-        self.val = val
-        self.time = time
-
-    def __repr__(self):
-        return f"<value={self.val}, hour={self.time}>"
-    
 class DatabaseManager:
     def __init__(self, db_name: str):
         self.connection = sqlite3.connect(db_name)
-        self.cursor = self.connection.cursor()
-
-    def get_cons_by_constype(self, locuinta_id: int, consumer_id : int, consumer : str) -> List[Consumer]:
-        self.cursor.execute('SELECT ApplianceIDREF, EpochTime, Value FROM Consumption WHERE HouseIDREF = ? AND ApplianceIDREF = ? AND EpochTime >= 886709400 AND EpochTime <= 918244800', (locuinta_id, consumer_id))
-        rows = self.cursor.fetchall()
-        consumers = []
-        for i in range(0, len(rows), 6):
-            group = rows[i:i+6]
-            if len(group) < 6:
-                break 
-
-            ApplianceIDREF = group[0][0]
-            EpochTime = group[5][1]
-            Value = sum(row[2] for row in group)
-            
-            consumer_obj = Consumer(ApplianceIDREF, consumer, datetime.datetime.utcfromtimestamp(EpochTime), Value)
-            consumers.append(consumer_obj)
-        
-        return consumers
-    
-    def get_rayonnement(self, station_id: int, parameter_id : int) -> List[Rayonnement]:
-        self.cursor.execute('SELECT Value, EpochTime FROM WeatherData WHERE WeatherStationIDREF = ? AND WeatherVariableIDREF = ? AND EpochTime >= 886712400 AND EpochTime <= 918244800', (station_id, parameter_id))
-        rows = self.cursor.fetchall()
-        return [Rayonnement(Value, datetime.datetime.fromtimestamp(EpochTime)) for Value, EpochTime in rows]
-
-    def get_production(self, station_id : int, parameter_id : int, nominal_power: int, nr_panels : int, f : float) -> List[Production]:
-        self.cursor.execute('SELECT Value, EpochTime FROM WeatherData WHERE WeatherStationIDREF = ? AND WeatherVariableIDREF = ? AND EpochTime >= 886712400 AND EpochTime <= 918244800', (station_id, parameter_id))
-        rows = self.cursor.fetchall()
-        return [Production(nominal_power * nr_panels * f * Value/1000, datetime.datetime.fromtimestamp(EpochTime)) for Value, EpochTime in rows]
+        # The indexes are written with the default journal and sync settings, the faster PRAGMAs are only safe for reading
+        self.create_indexes()
+        self.connection.executescript('; '.join(READ_PRAGMAS) + ';')
+
+        # PRAGMAs only apply to their own connection, so the ADBC one the reads go through gets them too. It runs in
+        # autocommit mode, SQLite refuses to change the sync level inside the transaction ADBC opens otherwise
+        self.arrow_connection = None
+        if adbc_sqlite is not None:
+            self.arrow_connection = adbc_sqlite.connect(db_name, autocommit=True)
+            cursor = self.arrow_connection.cursor()
+            try:
+                for pragma in READ_PRAGMAS:
+                    cursor.execute(pragma)
+            finally:
+                cursor.close()
+
+    def create_indexes(self):
+        # Covering indexes, so the queries are answered from the index pages alone. Built once per database file
+        indexes = {name for (name,) in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        if not {'idx_cons_cover', 'idx_weather_cover'} <= indexes:
+            self.connection.executescript(
+                'CREATE INDEX IF NOT EXISTS idx_cons_cover ON Consumption(HouseIDREF, ApplianceIDREF, EpochTime, Value); '
+                'CREATE INDEX IF NOT EXISTS idx_weather_cover ON WeatherData(WeatherStationIDREF, WeatherVariableIDREF, EpochTime, Value); '
+                'ANALYZE;')
+
+    def read_table(self, sql: str, params: Tuple) -> Dict[str, np.ndarray]:
+        # Fetch the result as an Arrow table through ADBC, so no Python tuple is built per row
+        if self.arrow_connection is not None:
+            cursor = self.arrow_connection.cursor()
+            try:
+                cursor.execute(sql, params)
+                table = cursor.fetch_arrow_table()
+            finally:
+                cursor.close()
+            return {name: table.column(name).to_numpy() for name in table.column_names}
+        df = pd.read_sql_query(sql, self.connection, params=params)
+        return {name: df[name].to_numpy() for name in df.columns}
+
+    def read_columns(self, sql: str, params: Tuple) -> Tuple[np.ndarray, np.ndarray]:
+        # Load the EpochTime and Value columns as contiguous arrays
+        columns = self.read_table(sql, params)
+        return columns['EpochTime'].astype(np.int64, copy=False).view('datetime64[s]'), columns['Value'].astype(np.float32, copy=False)
+
+    def get_cons_by_constypes(self, locuinta_id: int, consumer_ids: List[int]) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        # Sum the 10-minute samples of every appliance into hours in one query, timestamped by the last sample of the hour
+        placeholders = ', '.join('?' * len(consumer_ids))
+        columns = self.read_table(
+            f'SELECT ApplianceIDREF, MAX(EpochTime) AS EpochTime, SUM(Value) AS Value FROM Consumption WHERE HouseIDREF = ? AND ApplianceIDREF IN ({placeholders}) AND EpochTime >= 886709400 AND EpochTime <= 918244800 '
+            'GROUP BY ApplianceIDREF, (EpochTime - 886709400) / 3600 HAVING COUNT(*) = 6 ORDER BY ApplianceIDREF, EpochTime',
+            (locuinta_id, *consumer_ids))
+
+        appliance_ids = columns['ApplianceIDREF']
+        times = columns['EpochTime'].astype(np.int64, copy=False).view('datetime64[s]')
+        values = columns['Value'].astype(np.float32, copy=False)
+        return {consumer_id: (times[appliance_ids == consumer_id], values[appliance_ids == consumer_id]) for consumer_id in consumer_ids}
+
+    def get_rayonnement(self, station_id: int, parameter_id : int) -> Tuple[np.ndarray, np.ndarray]:
+        return self.read_columns('SELECT EpochTime, Value FROM WeatherData WHERE WeatherStationIDREF = ? AND WeatherVariableIDREF = ? AND EpochTime >= 886712400 AND EpochTime <= 918244800 ORDER BY EpochTime', (station_id, parameter_id))
 
     def close(self):
+        if self.arrow_connection is not None:
+            self.arrow_connection.close()
         self.connection.close()
 
+# Cached loaders, shared across Streamlit reruns and with the optimizer in main.py
+
+# Both return the hourly values on HOUR_AXIS and the mask of the hours found in the database
+
+@st.cache_data(show_spinner=False)
+def load_consumers(db_name: str, house_id: int) -> Tuple[np.ndarray, np.ndarray]:
+    db_manager = DatabaseManager(db_name)
+    try:
+        consumers = db_manager.get_cons_by_constypes(house_id, list(APPLIANCES))
+    finally:
+        db_manager.close()
+
+    # Sum the appliances straight into the hours of the axis
+    hourly_consumption = np.zeros(NR_HOURS, dtype=np.float32)
+    present = np.zeros(NR_HOURS, dtype=bool)
+    for times, values in consumers.values():
+        hour_idx = (times - HOUR_AXIS[0]) // np.timedelta64(1, 'h')
+        np.add.at(hourly_consumption, hour_idx, values)
+        present[hour_idx] = True
+    return hourly_consumption, present
+
+@st.cache_data(show_spinner=False)
+def load_rayonnement(db_name: str, station_id: int) -> Tuple[np.ndarray, np.ndarray]:
+    db_manager = DatabaseManager(db_name)
+    try:
+        return _scatter_on_axis(*db_manager.get_rayonnement(station_id, 4))
+    finally:
+        db_manager.close()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _render_png(digest: str, _fig: Figure) -> bytes:
+    # The figure itself is not hashed (leading underscore), the digest of its name and line data identifies it
+    buffer = io.BytesIO()
+    # About 1200px wide for the 15in figures, under the 1460px above which st.image resizes and re-encodes the PNG on every call
+    _fig.savefig(buffer, format='png', bbox_inches='tight', dpi=96)
+    return buffer.getvalue()
+
+# Calendar fields of datetime64 arrays
+
+def hour_of_day(times: np.ndarray) -> np.ndarray:
+    return times.astype('datetime64[h]').astype(np.int64) % 24
+
+def day_of_month(times: np.ndarray) -> np.ndarray:
+    return (times.astype('datetime64[D]') - times.astype('datetime64[M]')).astype(np.int64) + 1
+
+def day_of_week(times: np.ndarray) -> np.ndarray:
+    # 1970-01-01 was a Thursday, Monday is 0
+    return (times.astype('datetime64[D]').astype(np.int64) + 3) % 7
+
+def _scatter_on_axis(times: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Place the values on the matching hours of HOUR_AXIS, the missing hours stay 0
+    idx = np.searchsorted(HOUR_AXIS, times).clip(max=NR_HOURS - 1)
+    on_axis = HOUR_AXIS[idx] == times
+    scattered = np.zeros(NR_HOURS, dtype=values.dtype)
+    scattered[idx[on_axis]] = values[on_axis]
+    present = np.zeros(NR_HOURS, dtype=bool)
+    present[idx[on_axis]] = True
+    return scattered, present
+
+@njit(cache=True, fastmath=True)
+def _daily_metrics(prod: np.ndarray, cons: np.ndarray, day_idx: np.ndarray, n_days: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # One pass over the aligned hours: per-day sums of min(p, c), p, c and |p - c|
+    sum_min = np.zeros(n_days)
+    sum_prod = np.zeros(n_days)
+    sum_cons = np.zeros(n_days)
+    sum_abs = np.zeros(n_days)
+    for i in range(prod.size):
+        d = day_idx[i]
+        p = prod[i]
+        c = cons[i]
+        sum_min[d] += p if p < c else c
+        sum_prod[d] += p
+        sum_cons[d] += c
+        sum_abs[d] += p - c if p > c else c - p
+    return sum_min, sum_prod, sum_cons, sum_abs
+
+def _bucket_mean(keys: np.ndarray, values: np.ndarray, present: np.ndarray, n_buckets: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Mean over the present hours falling in each integer bucket, plus the mask of non-empty buckets
+    sums = np.bincount(keys, weights=values, minlength=n_buckets)
+    counts = np.bincount(keys, weights=present, minlength=n_buckets)
+    return sums / np.maximum(counts, 1), counts > 0
+
+def _lttb(times: np.ndarray, values: np.ndarray, n_out: int = 2000) -> Tuple[np.ndarray, np.ndarray]:
+    # Largest-Triangle-Three-Buckets downsampling, keeps the first and last points and the most visible one of each bucket
+    n = values.size
+    if n <= n_out or n_out < 3:
+        return times, values
+
+    x = times.astype('datetime64[s]').astype(np.float64)
+    y = values.astype(np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+
+    # Mean point of every bucket at once, the last point being a bucket of its own
+    counts = np.diff(np.append(edges, n))
+    avg_x = np.add.reduceat(x, edges) / counts
+    avg_y = np.add.reduceat(y, edges) / counts
+
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        area = np.abs((x[a] - avg_x[i + 1]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y[i + 1] - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return times[selected], values[selected]
+
 # Main Class for plotting
 
 class EnergyAnalysis:
@@ -88,54 +234,55 @@ class EnergyAnalysis:
         self.nr_panels = nr_panels
         self.f = f
 
-        self.db_manager = DatabaseManager(db_name)
-        self.consumers_data = self.load_consumers_data()
-        self.rayonnement_data = self.load_rayonnement_data()
-        self.production_data = self.load_production_data()
-
-        self.hourly_consumption = self.aggregate_hourly_consumption()
-        self.hourly_production = {prod.time: prod.val for prod in self.production_data}
-
-    def load_consumers_data(self) -> List[List[Consumer]]:
-        return [
-            self.db_manager.get_cons_by_constype(self.house_id, 0, 'water pump'),
-            self.db_manager.get_cons_by_constype(self.house_id, 1, 'water heater'),
-            self.db_manager.get_cons_by_constype(self.house_id, 2, 'washing machine'),
-            self.db_manager.get_cons_by_constype(self.house_id, 4, 'freezer'),
-            self.db_manager.get_cons_by_constype(self.house_id, 5, 'fridge freezer'),
-            self.db_manager.get_cons_by_constype(self.house_id, 6, 'total site light'),
-            self.db_manager.get_cons_by_constype(self.house_id, 7, 'TV'),
-            self.db_manager.get_cons_by_constype(self.house_id, 9, 'boiler')
-        ]
-
-    def load_rayonnement_data(self) -> List[Rayonnement]:
-        return self.db_manager.get_rayonnement(self.station_id, 4)
-
-    def load_production_data(self) -> List[Production]:
-        return self.db_manager.get_production(self.station_id, 4, self.nominal_power, self.nr_panels, self.f)
-
-    def close(self):
-        self.db_manager.close()
-
-    ## 1.1. Aggregate hourly consumption values
-     
-    def aggregate_hourly_consumption(self) -> Dict[datetime.datetime, float]:
-        hourly_consumption = {}
-        for consumer_list in self.consumers_data:
-            for consumer in consumer_list:
-                time_key = consumer.time
-                if time_key not in hourly_consumption:
-                    hourly_consumption[time_key] = 0.0
-                hourly_consumption[time_key] += consumer.val
-        return hourly_consumption
+        # Both series are on the hours of HOUR_AXIS, with the mask of the hours found in the database
+        self.cons, self.cons_present = self.load_consumers_data()
+        self.rayonnement, self.prod_present = self.load_rayonnement_data()
+
+        # The production only scales the cached rayonnement, so it needs no query of its own
+        self.prod = self.rayonnement * np.float32(self.nominal_power * self.nr_panels * self.f / 1000)
+
+        # Bucket keys of every hour for the (day of month, hour), (weekday, hour) and hour averages, built once
+        hour_idx = hour_of_day(HOUR_AXIS).astype(np.intp)
+        self.key_day_hour = (day_of_month(HOUR_AXIS).astype(np.intp) - 1) * 24 + hour_idx
+        self.key_week_hour = day_of_week(HOUR_AXIS).astype(np.intp) * 24 + hour_idx
+        self.key_hour = hour_idx
+        hour_days = HOUR_AXIS.astype('datetime64[D]')
+        self.day_idx = (hour_days - hour_days[0]).astype(np.int64)
+        self.days = hour_days[0] + np.arange(self.day_idx[-1] + 1)
+        # Days with both consumption and production rows, the only ones the daily indicators and their yearly totals cover
+        self.day_present = ((np.bincount(self.day_idx, weights=self.cons_present, minlength=self.days.size) > 0)
+                            & (np.bincount(self.day_idx, weights=self.prod_present, minlength=self.days.size) > 0))
+        self.daily_min_prod_load, self.daily_production, self.daily_consumption, self.daily_abs_exchange = _daily_metrics(self.prod, self.cons, self.day_idx, self.days.size)
+
+    def load_consumers_data(self) -> Tuple[np.ndarray, np.ndarray]:
+        return load_consumers(self.db_name, self.house_id)
+
+    def load_rayonnement_data(self) -> Tuple[np.ndarray, np.ndarray]:
+        return load_rayonnement(self.db_name, self.station_id)
+
+    def _draw_lines(self, lines: List[Tuple[Tuple[np.ndarray, np.ndarray], dict]]) -> Tuple[Figure, Axes]:
+        fig, ax = plt.subplots(figsize=(15, 7))
+        for (x, y), style in lines:
+            ax.plot(x, y, **style)
+        return fig, ax
+
+    def _show(self, name: str, fig: Figure):
+        # Encode the figure to PNG only when its data changed, an unchanged rerun reuses the cached bytes.
+        # The figure is closed once shown, pyplot would otherwise keep every figure of every rerun alive
+        digest = hashlib.blake2b(name.encode(), digest_size=16)
+        for handle in fig.gca().get_lines():
+            digest.update(np.ascontiguousarray(handle.get_xdata()).tobytes())
+            digest.update(np.ascontiguousarray(handle.get_ydata()).tobytes())
+        st.image(_render_png(digest.hexdigest(), fig))
+        plt.close(fig)
 
     ## 1.2. Plot the consumption versus production data for 1 year
 
     def plot_consumption_vs_production(self):
-        fig, ax = plt.subplots(figsize=(15, 7))
-        ax.plot(self.hourly_consumption.keys(), self.hourly_consumption.values(), label='Consumul orar')
-        ax.plot(self.hourly_production.keys(), self.hourly_production.values(), label='Producția orară', linestyle='--')
-
+        fig, ax = self._draw_lines([
+            (_lttb(HOUR_AXIS[self.cons_present], self.cons[self.cons_present]), dict(label='Consumul orar')),
+            (_lttb(HOUR_AXIS[self.prod_present], self.prod[self.prod_present]), dict(label='Producția orară', linestyle='--'))
+        ])
         fig.gca().xaxis.set_major_locator(mdates.MonthLocator())
         fig.gca().xaxis.set_major_formatter(mdates.DateFormatter('%d %b %Y'))
 
@@ -146,64 +293,24 @@ class EnergyAnalysis:
         ax.grid(True)
 
         plt.gcf().autofmt_xdate()
-        st.pyplot(fig)
+        self._show('consumption_vs_production', fig)
 
     ## 1.3. Plot the consumption versus production data for 1 month
 
     def plot_consumption_vs_production_monthly(self):
 
-        # Calculate the average consumption for each day and hour
-        hourly_consumption_month: Dict[Tuple[int, int], List[float]] = {}
-        for key in self.hourly_consumption.keys():
-            day_hour_key = (key.day, key.hour)
-            if day_hour_key not in hourly_consumption_month:
-                hourly_consumption_month[day_hour_key] = []
-            hourly_consumption_month[day_hour_key].append(self.hourly_consumption[key])
-
-        average_consumption = {}
-        for key in hourly_consumption_month:
-            average_consumption[key] = np.mean(hourly_consumption_month[key])
-
-        # Prepare data for plotting
-        times = []
-        values = []
-        year = 2000
-        month = 1
-
-        for day in range(1, 32): 
-            for hour in range(24):
-                time_key = (day, hour)
-                if time_key in average_consumption:
-                    times.append(datetime.datetime(year, month, day, hour))
-                    values.append(average_consumption[time_key])
-
+        # Calculate the average consumption and production for each day and hour
+        average_consumption, present = _bucket_mean(self.key_day_hour, self.cons, self.cons_present, 31 * 24)
+        average_production, present_prod = _bucket_mean(self.key_day_hour, self.prod, self.prod_present, 31 * 24)
 
-        # Calculate the average production for each day and hour
-        hourly_production_month = {}
-        for key in self.hourly_production.keys():
-            day_hour_key = (key.day, key.hour)
-            if day_hour_key not in hourly_production_month:
-                hourly_production_month[day_hour_key] = []
-            hourly_production_month[day_hour_key].append(self.hourly_production[key])
-
-        average_production = {key: np.mean(hourly_production_month[key]) for key in hourly_production_month}
-
-        # Prepare data for plotting
-        times_prod = []
-        values_prod = []
-
-        for day in range(1, 32):
-            for hour in range(24):
-                time_key = (day, hour)
-                if time_key in average_production:
-                    times_prod.append(datetime.datetime(year, month, day, hour))
-                    values_prod.append(average_production[time_key])
+        # Prepare data for plotting, bucket (day - 1) * 24 + hour is that hour of January 2000
+        hours = np.datetime64('2000-01-01') + np.arange(31 * 24) * np.timedelta64(1, 'h')
 
         # Plot the data
-        fig, ax = plt.subplots(figsize=(15, 7))
-        ax.plot(times, values, label='Consumul mediu orar pe o lună')
-        ax.plot(times_prod, values_prod, label='Producția medie orară pe o lună', linestyle='--')
-
+        fig, ax = self._draw_lines([
+            ((hours[present], average_consumption[present]), dict(label='Consumul mediu orar pe o lună')),
+            ((hours[present_prod], average_production[present_prod]), dict(label='Producția medie orară pe o lună', linestyle='--'))
+        ])
         fig.gca().xaxis.set_major_locator(mdates.DayLocator())
         fig.gca().xaxis.set_major_formatter(mdates.DateFormatter('%d %H:%M'))
 
@@ -214,63 +321,24 @@ class EnergyAnalysis:
         ax.grid(True)
 
         plt.gcf().autofmt_xdate()
-        st.pyplot(fig)
+        self._show('consumption_vs_production_monthly', fig)
 
     ## 1.4. Plot the consumption versus production data for 1 week
 
     def plot_consumption_vs_production_weekly(self):
-        hourly_consumption_week: Dict[Tuple[int, int], List[float]] = {}
-        for key in self.hourly_consumption.keys():
-            week_hour_key = (key.weekday(), key.hour)
-            if week_hour_key not in hourly_consumption_week:
-                hourly_consumption_week[week_hour_key] = []
-            hourly_consumption_week[week_hour_key].append(self.hourly_consumption[key])
-
-        # Calculate the average consumption for each day and hour of the week
-        average_consumption_week = {}
-        for key in hourly_consumption_week:
-            average_consumption_week[key] = np.mean(hourly_consumption_week[key])
-
-        # Sort the dictionary by day of the week and hour
-        sorted_average_consumption_week = dict(sorted(average_consumption_week.items()))
-
-        # Prepare data for plotting
-        times = []
-        values = []
-        start_date = datetime.datetime(2000, 1, 3)  # This is a Monday
-
-        for day, hour in sorted_average_consumption_week.keys():
-            times.append(start_date + datetime.timedelta(days=day, hours=hour))
-            values.append(sorted_average_consumption_week[(day, hour)])
 
-        # Compute the production data for 1 week + cons
-        hourly_production_week = {}
-        for key in self.hourly_production.keys():
-            week_hour_key = (key.weekday(), key.hour)
-            if week_hour_key not in hourly_production_week:
-                hourly_production_week[week_hour_key] = []
-            hourly_production_week[week_hour_key].append(self.hourly_production[key])
-
-        # Calculate the average production for each day and hour of the week
-        average_production_week = {key: np.mean(hourly_production_week[key]) for key in hourly_production_week}
-
-        # Sort the dictionary by day of the week and hour
-        sorted_average_production_week = dict(sorted(average_production_week.items()))
+        # Calculate the average consumption and production for each day and hour of the week
+        average_consumption_week, present = _bucket_mean(self.key_week_hour, self.cons, self.cons_present, 7 * 24)
+        average_production_week, present_prod = _bucket_mean(self.key_week_hour, self.prod, self.prod_present, 7 * 24)
 
         # Prepare data for plotting
-        times_prod = []
-        values_prod = []
-        start_date = datetime.datetime(2000, 1, 3)
-
-        for day, hour in sorted_average_production_week.keys():
-            times_prod.append(start_date + datetime.timedelta(days=day, hours=hour))
-            values_prod.append(sorted_average_production_week[(day, hour)])
+        hours = np.datetime64('2000-01-03') + np.arange(7 * 24) * np.timedelta64(1, 'h')  # 2000-01-03 is a Monday
 
         # Plot the data
-        fig, ax = plt.subplots(figsize=(15, 7))
-        ax.plot(times, values, label='Consumul mediu orar pe o săptămână')
-        ax.plot(times_prod, values_prod, label='Producșia medie orară pe o săptămână', linestyle='--')
-
+        fig, ax = self._draw_lines([
+            ((hours[present], average_consumption_week[present]), dict(label='Consumul mediu orar pe o săptămână')),
+            ((hours[present_prod], average_production_week[present_prod]), dict(label='Producșia medie orară pe o săptămână', linestyle='--'))
+        ])
         fig.gca().xaxis.set_major_locator(mdates.HourLocator(interval=6))
         fig.gca().xaxis.set_major_formatter(mdates.DateFormatter('%a %H:%M'))
 
@@ -281,63 +349,24 @@ class EnergyAnalysis:
         ax.grid(True)
 
         plt.gcf().autofmt_xdate()
-        st.pyplot(fig)
+        self._show('consumption_vs_production_weekly', fig)
 
     ## 1.5. Plot the consumption versus production data for 1 day
 
     def plot_consumption_vs_production_daily(self):
-        hourly_consumption_day: Dict[int, List[float]] = {}
-        for key in self.hourly_consumption.keys():
-            hour_key = key.hour
-            if hour_key not in hourly_consumption_day:
-                hourly_consumption_day[hour_key] = []
-            hourly_consumption_day[hour_key].append(self.hourly_consumption[key])
 
-        # Calculate the average consumption for each hour of the day
-        average_consumption_day = {}
-        for key in hourly_consumption_day:
-            average_consumption_day[key] = np.mean(hourly_consumption_day[key])
-
-        # Sort the dictionary by hour
-        sorted_average_consumption_day = dict(sorted(average_consumption_day.items()))
+        # Calculate the average consumption and production for each hour of the day
+        average_consumption_day, present = _bucket_mean(self.key_hour, self.cons, self.cons_present, 24)
+        average_production_day, present_prod = _bucket_mean(self.key_hour, self.prod, self.prod_present, 24)
 
         # Prepare data for plotting
-        times = []
-        values = []
-        generic_date = datetime.datetime(2000, 1, 1)
-
-        for hour in sorted_average_consumption_day.keys():
-            times.append(generic_date + datetime.timedelta(hours=hour))
-            values.append(sorted_average_consumption_day[hour])
-
-        # Compute the production data for 1 day
-        hourly_production_day = {}
-        for key in self.hourly_production.keys():
-            hour_key = key.hour
-            if hour_key not in hourly_production_day:
-                hourly_production_day[hour_key] = []
-            hourly_production_day[hour_key].append(self.hourly_production[key])
-
-        # Calculate the average production for each hour of the day
-        average_production_day = {key: np.mean(hourly_production_day[key]) for key in hourly_production_day}
-
-        # Sort the dictionary by hour
-        sorted_average_production_day = dict(sorted(average_production_day.items()))
-
-        # Prepare data for plotting
-        times_prod = []
-        values_prod = []
-        generic_date = datetime.datetime(2000, 1, 1)  # This is a generic date
-
-        for hour in sorted_average_production_day.keys():
-            times_prod.append(generic_date + datetime.timedelta(hours=hour))
-            values_prod.append(sorted_average_production_day[hour])
+        hours = np.datetime64('2000-01-01') + np.arange(24) * np.timedelta64(1, 'h')  # This is a generic date
 
         # Plot the data
-        fig, ax = plt.subplots(figsize=(15, 7))
-        ax.plot(times, values, label='Consumul mediu orar pe zi')
-        ax.plot(times_prod, values_prod, label='Producția medie orară pe zi', linestyle='--')
-
+        fig, ax = self._draw_lines([
+            ((hours[present], average_consumption_day[present]), dict(label='Consumul mediu orar pe zi')),
+            ((hours[present_prod], average_production_day[present_prod]), dict(label='Producția medie orară pe zi', linestyle='--'))
+        ])
         fig.gca().xaxis.set_major_locator(mdates.HourLocator(interval=1))
         fig.gca().xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
 
@@ -348,46 +377,23 @@ class EnergyAnalysis:
         ax.grid(True)
 
         plt.gcf().autofmt_xdate()
-        st.pyplot(fig)
+        self._show('consumption_vs_production_daily', fig)
 
 
     ### PART 2 - TECHNICAL INDICATOR ANALYSIS
 
     ## 2.1. Self-Consumption
 
-    def calculate_self_consumption_daily(self) -> Dict[datetime.date, float]:   
-        daily_self_consumption = {}
-        grouped_production = {}
-        grouped_consumption = {}
-
-        for time, production in self.hourly_production.items():
-            day = time.date()
-            if day not in grouped_production:
-                grouped_production[day] = []
-            grouped_production[day].append(production)
-    
-        for time, consumption in self.hourly_consumption.items():
-            day = time.date()
-            if day not in grouped_consumption:
-                grouped_consumption[day] = []
-            grouped_consumption[day].append(consumption)
-    
+    def calculate_self_consumption_daily(self) -> Tuple[np.ndarray, np.ndarray]:   
         # Compute daily SC
-        for day in grouped_production.keys():
-            if day in grouped_consumption:
-                prod_values = grouped_production[day]
-                cons_values = grouped_consumption[day]
-            
-                sum_min_prod_load = sum(min(p, c) for p, c in zip(prod_values, cons_values))
-                sum_total_production = sum(prod_values)
-
-                daily_self_consumption[day] = sum_min_prod_load / sum_total_production if sum_total_production != 0 else 0
-    
-        return daily_self_consumption
+        sum_total_production = self.daily_production
+        daily_self_consumption = np.where(sum_total_production != 0, self.daily_min_prod_load / np.where(sum_total_production == 0, 1, sum_total_production), 0)
 
-    def calculate_total_self_consumption(self, daily_self_consumption: Dict[datetime.date, float]) -> float:
+        return self.days[self.day_present], daily_self_consumption[self.day_present]
+
+    def calculate_total_self_consumption(self, daily_self_consumption: Tuple[np.ndarray, np.ndarray]) -> float:
         # Compute SC for the whole year
-        return sum(daily_self_consumption.values()) / len(daily_self_consumption)
+        return float(daily_self_consumption[1].mean())
     
     def plot_self_consumption(self):
         daily_self_consumption = self.calculate_self_consumption_daily()
@@ -395,9 +401,9 @@ class EnergyAnalysis:
         st.write(f"Autoconsumul: {total_self_consumption:.2%}")
 
         # Plot the SC
-        fig, ax = plt.subplots(figsize=(15, 7))
-        ax.plot(daily_self_consumption.keys(), daily_self_consumption.values(), label='Autoconsumul zilnic', marker='o')
-
+        fig, ax = self._draw_lines([
+            (daily_self_consumption, dict(label='Autoconsumul zilnic', marker='o'))
+        ])
         ax.set_xlabel('Data')
         ax.set_ylabel('Autoconsumul (%)')
         ax.set_title('Autoconsumul zilnic')
@@ -405,44 +411,21 @@ class EnergyAnalysis:
         ax.grid(True)
 
         fig.gca().xaxis.set_major_formatter(mdates.DateFormatter('%d %b %Y'))
-        plt.gcf().autofmt_xdate() 
-        st.pyplot(fig)
+        plt.gcf().autofmt_xdate()
+        self._show('self_consumption', fig)
 
     ## 2.2. Self-Sufficiency
 
-    def calculate_self_sufficiency_daily(self) -> Dict[datetime.date, float]:    
-        daily_self_sufficiency = {}
-        grouped_production = {}
-        grouped_consumption = {}
-
-        for time, production in self.hourly_production.items():
-            day = time.date()
-            if day not in grouped_production:
-                grouped_production[day] = []
-            grouped_production[day].append(production)
-    
-        for time, consumption in self.hourly_consumption.items():
-            day = time.date()
-            if day not in grouped_consumption:
-                grouped_consumption[day] = []
-            grouped_consumption[day].append(consumption)
-    
+    def calculate_self_sufficiency_daily(self) -> Tuple[np.ndarray, np.ndarray]:    
         # Compute daily SS
-        for day in grouped_production.keys():
-            if day in grouped_consumption:
-                prod_values = grouped_production[day]
-                cons_values = grouped_consumption[day]
-            
-                sum_min_prod_load = sum(min(p, c) for p, c in zip(prod_values, cons_values))
-                sum_total_consumption = sum(cons_values)
-
-                daily_self_sufficiency[day] = sum_min_prod_load / sum_total_consumption if sum_total_consumption != 0 else 0
-    
-        return daily_self_sufficiency
+        sum_total_consumption = self.daily_consumption
+        daily_self_sufficiency = np.where(sum_total_consumption != 0, self.daily_min_prod_load / np.where(sum_total_consumption == 0, 1, sum_total_consumption), 0)
 
-    def calculate_total_self_sufficiency(self, daily_self_sufficiency: Dict[datetime.date, float]) -> float:
+        return self.days[self.day_present], daily_self_sufficiency[self.day_present]
+
+    def calculate_total_self_sufficiency(self, daily_self_sufficiency: Tuple[np.ndarray, np.ndarray]) -> float:
         # Compute SS for the whole year
-        return sum(daily_self_sufficiency.values()) / len(daily_self_sufficiency)
+        return float(daily_self_sufficiency[1].mean())
     
     def plot_self_sufficiency(self):
         daily_self_sufficiency = self.calculate_self_sufficiency_daily()
@@ -450,9 +433,9 @@ class EnergyAnalysis:
         st.write(f"Autosuficiența: {total_self_sufficiency:.2%}")
 
         # Plot the SS
-        fig, ax = plt.subplots(figsize=(15, 7))
-        ax.plot(daily_self_sufficiency.keys(), daily_self_sufficiency.values(), label='Autosuficiența zilnică', marker='o')
-
+        fig, ax = self._draw_lines([
+            (daily_self_sufficiency, dict(label='Autosuficiența zilnică', marker='o'))
+        ])
         ax.set_xlabel('Data')
         ax.set_ylabel('Autosuficiența (%)')
         ax.set_title('Autosuficiența zilnică')
@@ -461,42 +444,19 @@ class EnergyAnalysis:
 
         fig.gca().xaxis.set_major_formatter(mdates.DateFormatter('%d %b %Y'))
         plt.gcf().autofmt_xdate()
-        st.pyplot(fig)
+        self._show('self_sufficiency', fig)
 
     # 2.3. NEEG (Net Energy Exchanged with the Grid)
 
-    def calculate_neeg_daily(self) -> Dict[datetime.date, float]:
-        daily_neeg = {}
-        grouped_production = {}
-        grouped_consumption = {}
-
-        for time, production in self.hourly_production.items():
-            day = time.date()
-            if day not in grouped_production:
-                grouped_production[day] = []
-            grouped_production[day].append(production)
-    
-        for time, consumption in self.hourly_consumption.items():
-            day = time.date()
-            if day not in grouped_consumption:
-                grouped_consumption[day] = []
-            grouped_consumption[day].append(consumption)
-    
+    def calculate_neeg_daily(self) -> Tuple[np.ndarray, np.ndarray]:
         # Calculate daily NEEG in kWh
-        for day in grouped_production.keys():
-            if day in grouped_consumption:
-                prod_values = grouped_production[day]
-                cons_values = grouped_consumption[day]
-            
-                sum_neeg = sum(abs(p - c) for p, c in zip(prod_values, cons_values))/1000
-
-                daily_neeg[day] = sum_neeg
-    
-        return daily_neeg
+        daily_neeg = self.daily_abs_exchange / 1000
 
-    def calculate_total_neeg(self, daily_neeg: Dict[datetime.date, float]) -> float:
+        return self.days[self.day_present], daily_neeg[self.day_present]
+
+    def calculate_total_neeg(self, daily_neeg: Tuple[np.ndarray, np.ndarray]) -> float:
         # Calculate NEEG for the whole year
-        return sum(daily_neeg.values()) 
+        return float(daily_neeg[1].sum())
     
     def plot_neeg(self):
         daily_neeg = self.calculate_neeg_daily()
@@ -505,9 +465,9 @@ class EnergyAnalysis:
         st.write(f"NEEG pe durata întregului an: {total_neeg:.2f} kWh")
 
         # Plot the NEEG
-        fig, ax = plt.subplots(figsize=(15, 7))
-        ax.plot(daily_neeg.keys(), daily_neeg.values(), label='NEEG zilnic', marker='o')
-
+        fig, ax = self._draw_lines([
+            (daily_neeg, dict(label='NEEG zilnic', marker='o'))
+        ])
         ax.set_xlabel('Data')
         ax.set_ylabel('NEEG (kWh)')
         ax.set_title('Energia netă interschimbată cu rețeaua (NEEG)')
@@ -515,5 +475,5 @@ class EnergyAnalysis:
         ax.grid(True)
 
         fig.gca().xaxis.set_major_formatter(mdates.DateFormatter('%d %b %Y'))
-        plt.gcf().autofmt_xdate() 
-        st.pyplot(fig)
+        plt.gcf().autofmt_xdate()
+        self._show('neeg', fig)
@@ -1,10 +1,10 @@
 import numpy as np
-import datetime
 from scipy.optimize import differential_evolution
-from typing import Dict, Tuple, List
-import sqlite3
+from numba import njit
+from math import comb
+from typing import Dict, Tuple
 import streamlit as st
-from analysis_module import EnergyAnalysis, Consumer, House, Production, Rayonnement
+from analysis_module import EnergyAnalysis, House, HOUR_AXIS, load_consumers, load_rayonnement
 
 # Panel characteristics
 panels = {
@@ -13,12 +13,18 @@ panels = {
     "High Efficiency": {"power": 415, "cost_per_watt": 0.31},
 }
 
+# The same characteristics as vectors, in the order of the optimized panel counts
+PANEL_POWER = np.array([panel["power"] for panel in panels.values()], dtype=np.float64)
+PANEL_COSTPW = np.array([panel["cost_per_watt"] for panel in panels.values()], dtype=np.float64)
+CAPEX_PER_UNIT = PANEL_POWER * PANEL_COSTPW
+
 # Define the known parameters
 c_grid = 0.25  # Cost of energy from the grid
 c_DAM = 0.1   # Cost of energy injected into the grid (Day Ahead Market)
 r = 0.05      # Discount rate
 Y = 5        # Time period (in years)
 surface_per_panel = 1.6 # Solar panel dimension (squared meters)
+f = 0.8       # Performance factor of the panels
 
 # Streamlit interface
 st.title("Optimizarea configurației unui sistem fotovoltaic")
@@ -42,267 +48,162 @@ Dimensiunile unui panou sunt de 1.6m lungime și 1m lățime. Determinați, mai
 min_self_sufficiency = st.number_input("Introduceți procentul minim de autosuficiență dorit (0-1): ", min_value=0.0, max_value=1.0, value=0.5)
 max_panels = st.number_input("Introduceți numărul maxim de panouri ce pot fi amplasate pe suprafața utilă a locuinței: ", min_value=1)
 
-# DB Class
-class DatabaseManager:
-    def __init__(self, db_name: str):
-        self.db_name = db_name
-        self.connection = None
-        self.cursor = None
-
-    def __enter__(self):
-        self.connection = sqlite3.connect(self.db_name)
-        self.cursor = self.connection.cursor()
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.close()
-
-    def get_cons_by_constype(self, locuinta_id: int, consumer_id: int, consumer: str) -> List[Consumer]:
-        self.cursor.execute(
-            'SELECT ApplianceIDREF, EpochTime, Value FROM Consumption WHERE HouseIDREF = ? AND ApplianceIDREF = ? AND EpochTime >= 886709400 AND EpochTime <= 918244800',
-            (locuinta_id, consumer_id))
-        rows = self.cursor.fetchall()
-
-        consumers = []
-        for i in range(0, len(rows), 6):
-            group = rows[i:i + 6]
-            if len(group) < 6:
-                break
-
-            ApplianceIDREF = group[0][0]
-            EpochTime = group[5][1]
-            Value = sum(row[2] for row in group)
-
-            consumer_obj = Consumer(ApplianceIDREF, consumer, datetime.datetime.utcfromtimestamp(EpochTime), Value)
-            consumers.append(consumer_obj)
-
-        return consumers
-
-    def get_rayonnement(self, station_id: int, parameter_id: int) -> List[Rayonnement]:
-        self.cursor.execute(
-            'SELECT Value, EpochTime FROM WeatherData WHERE WeatherStationIDREF = ? AND WeatherVariableIDREF = ? AND EpochTime >= 886712400 AND EpochTime <= 918244800',
-            (station_id, parameter_id))
-        rows = self.cursor.fetchall()
-        return [Rayonnement(Value, datetime.datetime.fromtimestamp(EpochTime)) for Value, EpochTime in rows]
-
-    def get_production(self, station_id: int, parameter_id: int, nominal_power: int, nr_panels: int, f: float) -> List[Production]:
-        self.cursor.execute(
-            'SELECT Value, EpochTime FROM WeatherData WHERE WeatherStationIDREF = ? AND WeatherVariableIDREF = ? AND EpochTime >= 886712400 AND EpochTime <= 918244800',
-            (station_id, parameter_id))
-        rows = self.cursor.fetchall()
-        return [Production(nominal_power * nr_panels * f * Value / 1000, datetime.datetime.fromtimestamp(EpochTime)) for
-                Value, EpochTime in rows]
-
-    def close(self):
-        if self.connection:
-            self.connection.close()
-
-# Extend the dataset to 5 years
-def extend_data_to_years(
-    hourly_production: Dict[datetime.datetime, float],
-    hourly_consumption: Dict[datetime.datetime, float],
-    years: int
-) -> Tuple[Dict[datetime.datetime, float], Dict[datetime.datetime, float]]:
-    extended_production = {}
-    extended_consumption = {}
-
-    for year in range(years):
-        for time, production in hourly_production.items():
-            new_time = time.replace(year=time.year + year)
-            extended_production[new_time] = production
-        
-        for time, consumption in hourly_consumption.items():
-            new_time = time.replace(year=time.year + year)
-            extended_consumption[new_time] = consumption
-
-    return extended_production, extended_consumption
-
-# Compute monthly costs
-def calculate_monthly_costs(
-    hourly_production: Dict[datetime.datetime, float],
-    hourly_consumption: Dict[datetime.datetime, float],
+# The rayonnement and the total hourly consumption do not depend on the panel configuration. They come from the analysis
+# module's cached loaders, so the optimizer and the analysis share the same queries and the same cache.
+# Returns aligned arrays over the consumption hours: rayonnement (0 where missing), consumption and the month index of every hour
+def load_hourly_data(db_name: str, house_id: int, station_id: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    consumption, present = load_consumers(db_name, house_id)
+    rayonnement, _ = load_rayonnement(db_name, station_id)
+
+    # The calendar month is only derived once for the whole array
+    months = HOUR_AXIS[present].astype('datetime64[M]')
+    month_idx = (months - months[0]).astype(np.int16)
+
+    # The loaders keep the hourly values in float32, which halves the memory the kernel streams through, the sums stay in float64
+    return rayonnement[present], consumption[present], month_idx
+
+# Discount weights of the months of the 1-year data over the whole horizon. Month k of year y is month k + 12 * y of the horizon,
+# where the last month of a year and the first of the next one can be the same calendar month
+def calculate_discount_weights(n_months: int, r: float, years: int) -> Tuple[np.ndarray, float]:
+    horizon_months = np.arange(n_months)[np.newaxis, :] + 12 * np.arange(years)[:, np.newaxis]
+    horizon = np.unique(horizon_months)
+    discount = (1 + r) ** (-np.arange(horizon.size) / 12)
+
+    # Every year repeats the same costs, so each month of the data is weighted by its discounts summed over the years
+    monthly_weights = discount[np.searchsorted(horizon, horizon_months)].sum(axis=0)
+    return monthly_weights, float(discount.sum())
+
+hourly_rayonnement, hourly_consumption, month_idx = load_hourly_data("irise.sqlite3", 2000916, 26198001)
+
+# Monthly consumption, the same for every configuration
+monthly_e_consumption = np.bincount(month_idx, weights=hourly_consumption) / 1000
+monthly_weights, horizon_weight = calculate_discount_weights(monthly_e_consumption.size, r, Y)
+
+# NPV and SS of every candidate in a single pass over the hours: monthly energy taken from and injected to the grid,
+# discounted over the horizon, and the self-consumed energy.
+# Not cached on disk: Streamlit runs this file as a script, so Numba could not reload the cached module
+@njit(fastmath=True)
+def evaluate_kernel(
+    production_factor: np.ndarray,
+    CapEX: np.ndarray,
+    hourly_rayonnement: np.ndarray,
+    hourly_consumption: np.ndarray,
+    month_idx: np.ndarray,
+    monthly_e_consumption: np.ndarray,
+    monthly_weights: np.ndarray,
+    horizon_weight: float,
     c_grid: float,
     c_DAM: float
-) -> Dict[Tuple[int, int], Tuple[float, float]]:
-    monthly_costs = {}
-    monthly_e_grid = {}
-    monthly_e_injected = {}
-
-    for time, consumption in hourly_consumption.items():
-        production = hourly_production.get(time, 0)
-        year_month = (time.year, time.month)
-
-        if year_month not in monthly_e_grid:
-            monthly_e_grid[year_month] = 0.0
-        if year_month not in monthly_e_injected:
-            monthly_e_injected[year_month] = 0.0
-
-        if consumption > production:
-            # Energy taken from the grid
-            monthly_e_grid[year_month] += (consumption - production) / 1000
-        else:
-            # Energy injected to the grid
-            monthly_e_injected[year_month] += (production - consumption) / 1000
-
-    for year_month in monthly_e_grid:
-        # Cost without panels
-        cost_without_panels = sum(
-            hourly_consumption[time] for time in hourly_consumption if (time.year, time.month) == year_month
-        ) / 1000 * c_grid
-
-        # Cost with panels
-        e_grid = monthly_e_grid[year_month]
-        e_injected = monthly_e_injected[year_month]
-        cost_with_panels = e_grid * c_grid - e_injected * c_DAM
-
-        monthly_costs[year_month] = (cost_without_panels, cost_with_panels)
-
-    return monthly_costs
-
-
-# Compute NPV
-def calculate_npv(
-    monthly_costs: Dict[Tuple[int, int], Tuple[float, float]],
-    CapEX: float,
-    r: float,
-    Y: int
-) -> float:
-    OpEX = 0.03 * CapEX
-    npv = -CapEX
-    sorted_months = sorted(monthly_costs.keys())  # Sortează cheile care sunt acum de tip (an, luna)
-    monthly_npv_values = []
-
-    for t, year_month in enumerate(sorted_months, start=1):
-        cost_without_panels, cost_with_panels = monthly_costs[year_month]
-        G_t = cost_without_panels - cost_with_panels
-        npv += (G_t - (OpEX / 12)) / ((1 + r) ** ((t - 1) / 12))
-        monthly_npv_values.append((year_month, npv))
-
-    return npv, monthly_npv_values
+) -> Tuple[np.ndarray, np.ndarray]:
+    n_candidates = production_factor.size
+    n_months = monthly_e_consumption.size
+    npv = np.empty(n_candidates)
+    self_sufficiency = np.empty(n_candidates)
+    sum_total_consumption = 0.0
+    for i in range(hourly_consumption.size):
+        sum_total_consumption += hourly_consumption[i]
+
+    monthly_e_grid = np.empty(n_months)
+    monthly_e_injected = np.empty(n_months)
+    for j in range(n_candidates):
+        monthly_e_grid[:] = 0.0
+        monthly_e_injected[:] = 0.0
+        sum_min_prod_load = 0.0
+        for i in range(hourly_consumption.size):
+            consumption = np.float64(hourly_consumption[i])
+            production = production_factor[j] * hourly_rayonnement[i]
+            m = month_idx[i]
+            if consumption > production:
+                monthly_e_grid[m] += consumption - production
+            else:
+                monthly_e_injected[m] += production - consumption
+            sum_min_prod_load += min(consumption, production)
+
+        # Monthly gain = cost without panels - cost with panels, discounted over the horizon, minus the OpEX
+        OpEX = 0.03 * CapEX[j]
+        gains = 0.0
+        for m in range(n_months):
+            cost_without_panels = monthly_e_consumption[m] * c_grid
+            cost_with_panels = monthly_e_grid[m] / 1000 * c_grid - monthly_e_injected[m] / 1000 * c_DAM
+            gains += (cost_without_panels - cost_with_panels) * monthly_weights[m]
+        npv[j] = -CapEX[j] + gains - (OpEX / 12) * horizon_weight
+
+        # SS, the same every year
+        self_sufficiency[j] = sum_min_prod_load / sum_total_consumption
+
+    return npv, self_sufficiency
+
+# NPV and SS of the configurations, one per column of the (3, M) panel counts
+def evaluate_configurations(panel_counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    CapEX = CAPEX_PER_UNIT @ panel_counts
+
+    # The production only scales the rayonnement loaded at startup
+    peak_power = PANEL_POWER @ panel_counts
+    return evaluate_kernel(
+        peak_power * f / 1000, CapEX, hourly_rayonnement, hourly_consumption, month_idx,
+        monthly_e_consumption, monthly_weights, horizon_weight, c_grid, c_DAM)
 
+# NPV and SS already computed, by (low-cost, standard, high efficiency) panel counts
+evaluated_configurations: Dict[Tuple[int, int, int], Tuple[float, float]] = {}
 
+# Objective of the optimization. x holds the panel counts, one candidate per column when called with shape (3, M)
 def npv_function(x):
-    num_low_cost = int(x[0])
-    num_standard = int(x[1])
-    num_high_efficiency = int(x[2])
-    x = [int(x[0]), int(x[1]), int(x[2])]
-
-    CapEX = (
-        num_low_cost * panels["Low-cost"]["power"] * panels["Low-cost"]["cost_per_watt"] +
-        num_standard * panels["Standard"]["power"] * panels["Standard"]["cost_per_watt"] +
-        num_high_efficiency * panels["High Efficiency"]["power"] * panels["High Efficiency"]["cost_per_watt"]
+    x = np.asarray(x, dtype=np.float64)
+    panel_counts = [tuple(config) for config in np.trunc(x.reshape(3, -1)).astype(np.int64).T.tolist()]
+
+    # DE keeps proposing the same integer configurations, only evaluate the new ones
+    new_configurations = list(dict.fromkeys(config for config in panel_counts if config not in evaluated_configurations))
+    if new_configurations:
+        npv, self_sufficiency = evaluate_configurations(np.array(new_configurations, dtype=np.float64).T)
+        evaluated_configurations.update(zip(new_configurations, zip(npv.tolist(), self_sufficiency.tolist())))
+
+    npv, self_sufficiency = np.array([evaluated_configurations[config] for config in panel_counts]).T
+    total_panels = np.array(panel_counts).sum(axis=1)
+
+    # Verify the panel number, then the SS constraint. The SS penalty grows linearly with the deficit from 250000, so the
+    # infeasible solutions closer to the target always score better, and stays at or below the panel penalty since deficit <= 1
+    deficit = np.maximum(min_self_sufficiency - self_sufficiency, 0.0)
+    objective = np.where(
+        total_panels > max_panels,
+        1000000.0,
+        np.where(deficit > 0, 250000 + deficit * 750000, -npv)
     )
 
-    nominal_power_low = panels["Low-cost"]["power"]
-    nominal_power_standard = panels["Standard"]["power"]
-    nominal_power_high = panels["High Efficiency"]["power"]
-
-    with DatabaseManager("irise.sqlite3") as db_manager:
-        # Calculate the consumption and production based on the current panel configuration
-        production_low = db_manager.get_production(
-            station_id=26198001,
-            parameter_id=4,
-            nominal_power=nominal_power_low,
-            nr_panels=num_low_cost,
-            f=0.8
-        )
-
-        production_standard = db_manager.get_production(
-            station_id=26198001,
-            parameter_id=4,
-            nominal_power=nominal_power_standard,
-            nr_panels=num_standard,
-            f=0.8
-        )
-
-        production_high = db_manager.get_production(
-            station_id=26198001,
-            parameter_id=4,
-            nominal_power=nominal_power_high,
-            nr_panels=num_high_efficiency,
-            f=0.8
-        )
-        
-        hourly_production = {prod.time: prod.val for prod in production_low}
-        for prod in production_standard:
-            if prod.time in hourly_production:
-                hourly_production[prod.time] += prod.val
-            else:
-                hourly_production[prod.time] = prod.val
-        for prod in production_high:
-            if prod.time in hourly_production:
-                hourly_production[prod.time] += prod.val
-            else:
-                hourly_production[prod.time] = prod.val
-
-        consumers_data = [
-            db_manager.get_cons_by_constype(2000916, 0, 'water pump'),
-            db_manager.get_cons_by_constype(2000916, 1, 'water heater'),
-            db_manager.get_cons_by_constype(2000916, 2, 'washing machine'),
-            db_manager.get_cons_by_constype(2000916, 4, 'freezer'),
-            db_manager.get_cons_by_constype(2000916, 5, 'fridge freezer'),
-            db_manager.get_cons_by_constype(2000916, 6, 'total site light'),
-            db_manager.get_cons_by_constype(2000916, 7, 'TV'),
-            db_manager.get_cons_by_constype(2000916, 9, 'boiler')
-        ]
-
-        hourly_consumption = {}
-        for consumer_list in consumers_data:
-            for consumer in consumer_list:
-                time_key = consumer.time
-                if time_key not in hourly_consumption:
-                    hourly_consumption[time_key] = 0.0
-                hourly_consumption[time_key] += consumer.val
-
-    # Extend to 5 years
-    hourly_production_extended, hourly_consumption_extended = extend_data_to_years(hourly_production, hourly_consumption, Y)
-
-    # Compute monthly costs
-    monthly_costs = calculate_monthly_costs(hourly_production_extended, hourly_consumption_extended, c_grid, c_DAM)
-
-    # Compute NPV
-    npv, _ = calculate_npv(monthly_costs, CapEX, r, Y)
-
-    # Compute SS
-    sum_total_consumption = sum(hourly_consumption_extended.values())
-    sum_min_prod_load = sum(min(hourly_consumption_extended[time], hourly_production_extended.get(time, 0)) for time in hourly_consumption_extended)
-
-    self_sufficiency = sum_min_prod_load / sum_total_consumption
-    print(npv, self_sufficiency, num_low_cost + num_standard + num_high_efficiency)
-
-    # Verify panel number
-    if num_low_cost + num_standard + num_high_efficiency > max_panels:
-        return float('1000000')
- 
-    # Verify SS constraint and add weights based on how far from the target the solution is
-    if self_sufficiency < min_self_sufficiency - 0.1:
-        return float('500000')
-    if self_sufficiency < min_self_sufficiency - 0.05:
-        return float('450000')
-    if self_sufficiency < min_self_sufficiency - 0.03:
-        return float('400000')
-    if self_sufficiency < min_self_sufficiency - 0.02:
-        return float('350000')
-    if self_sufficiency < min_self_sufficiency - 0.01:
-        return float('300000')
-    if self_sufficiency < min_self_sufficiency:
-        return float(250000 + (min_self_sufficiency - self_sufficiency) * 1000000)
-
-    return -npv
+    return objective if x.ndim == 2 else float(objective[0])
 
 # Run optimization for each panel type
 if st.button("Rulează programul"):
     # Container for text display while running, then erase after finish
     text_container = st.empty()
-    text_container.write("Se determină configurația optimă... (poate dura aprox. 30 minute)")
-
-    bounds = [(0, max_panels), (0, max_panels), (0, max_panels)]  # limits for panel number
-
-    result = differential_evolution(npv_function, bounds, strategy='best1bin', maxiter=500)
-    optimal_config = [int(result.x[0]), int(result.x[1]), int(result.x[2])]
-    optimal_npv = -result.fun
+    text_container.write("Se determină configurația optimă...")
+
+    # Number of configurations with at most max_panels panels, about 302k for 120 panels which takes a few seconds
+    if comb(max_panels + 3, 3) <= 350000:
+        # Small search space: evaluate every configuration within the panel limit, exact and faster than DE
+        panel_range = np.arange(max_panels + 1)
+        configurations = np.array(np.meshgrid(panel_range, panel_range, panel_range, indexing='ij')).reshape(3, -1)
+        configurations = configurations[:, configurations.sum(axis=0) <= max_panels]
+        objective = npv_function(configurations)
+
+        # Same peak power gives the same score when the SS target is missed, prefer the cheaper configuration then
+        best = np.lexsort((CAPEX_PER_UNIT @ configurations, objective))[0]
+        optimal_x = configurations[:, best]
+    else:
+        bounds = [(0, max_panels), (0, max_panels), (0, max_panels)]  # limits for panel number
+
+        # The whole population is evaluated in one call of the objective
+        result = differential_evolution(
+            npv_function, bounds, strategy='best1bin', maxiter=200, mutation=(0.5, 1.0), recombination=0.9,
+            init='sobol', integrality=[True, True, True], vectorized=True, updating='deferred', polish=False, seed=0)
+        optimal_x = result.x
+
+    optimal_config = [int(optimal_x[0]), int(optimal_x[1]), int(optimal_x[2])]
+    # The objective of a configuration missing the SS target is its penalty, take the NPV itself from the evaluated ones
+    optimal_npv, optimal_self_sufficiency = evaluated_configurations[tuple(optimal_config)]
 
     text_container.empty()
+    if optimal_self_sufficiency < min_self_sufficiency:
+        st.write(f"Procentul de autosuficiență dorit nu poate fi atins cu cel mult {max_panels} panouri, configurația cea mai apropiată atinge {optimal_self_sufficiency:.2%}.")
     st.write(f"Configurația optimă: {optimal_config[0]} panouri Low-Cost, {optimal_config[1]} panouri Standard, {optimal_config[2]} panouri High-Efficiency")
     st.write(f"NPV-ul investiției după 5 ani: {optimal_npv}")
 
@@ -310,15 +211,18 @@ if st.button("Rulează programul"):
     house_id = 2000916
     station_id = 26198001
     nr_panels = optimal_config[0] + optimal_config[1] + optimal_config[2]
-    nominal_power = (optimal_config[0] * panels["Low-cost"]["power"] + optimal_config[1] * panels["Standard"]["power"] + optimal_config[2] * panels["High Efficiency"]["power"]) / nr_panels
-    f = 0.8
-
-    analysis = EnergyAnalysis(db_name, house_id, station_id, nominal_power, nr_panels, f)
-
-    analysis.plot_consumption_vs_production()
-    analysis.plot_consumption_vs_production_monthly()
-    analysis.plot_consumption_vs_production_weekly()
-    analysis.plot_consumption_vs_production_daily()
-    analysis.plot_self_consumption()
-    analysis.plot_self_sufficiency()
-    analysis.plot_neeg()
+
+    if nr_panels == 0:
+        st.write("Configurația optimă nu conține niciun panou, nu există date de producție de analizat. Încercați un număr maxim de panouri mai mare sau un procent de autosuficiență mai mic.")
+    else:
+        nominal_power = float(PANEL_POWER @ optimal_config) / nr_panels
+
+        analysis = EnergyAnalysis(db_name, house_id, station_id, nominal_power, nr_panels, f)
+
+        analysis.plot_consumption_vs_production()
+        analysis.plot_consumption_vs_production_monthly()
+        analysis.plot_consumption_vs_production_weekly()
+        analysis.plot_consumption_vs_production_daily()
+        analysis.plot_self_consumption()
+        analysis.plot_self_sufficiency()
+        analysis.plot_neeg()